@@ -1,38 +1,46 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, Header, Query, Request, UploadFile, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
 import uvicorn
+import hmac
 import os
-import tempfile
-import shutil
 from pathlib import Path
 import time
-import json
-from typing import List, Dict
+import threading
+from typing import List, Dict, Optional, Tuple, Union
 import numpy as np
+import orjson
 from ultralytics import YOLO
 from src.img2vec_resnet18 import Img2VecResnet18
-from sklearn.neighbors import NearestNeighbors
-from collections import Counter
-import joblib
-import glob
+from src.deadline_policy import DeadlinePolicy
+from src.image_io import crop_box, decode_image_bytes
+from src.knowledge_base import DEFAULT_KNOWLEDGE_BASE, KnowledgeBase, KnowledgeBaseCache
+from src.profiling import ProfileCapture
+from src.response_encoding import LAYOUTS, build_detection_response
+from PIL import Image
 
 app = FastAPI(title="Shelf Product Identifier API", version="1.0.0")
 
-# Global variables for models
-yolo_model = None
-img2vec_model = None
-knn_model = None
-classes = None
-embeddings = None
+# Memory budget for cached knowledge bases (k-NN indexes)
+KB_CACHE_MAX_BYTES = int(os.environ.get("KB_CACHE_MAX_MB", "1024")) * 1024 * 1024
+# /admin endpoints are disabled unless this is set, and then require a
+# matching X-Admin-Token header
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
 class ProductDetector:
     def __init__(self):
         self.yolo_model = None
         self.img2vec_model = None
-        self.knn_model = None
-        self.classes = None
-        self.embeddings = None
+        # k-NN indexes are loaded per knowledge base on first use
+        self.knowledge_bases = KnowledgeBaseCache(KB_CACHE_MAX_BYTES)
         self.model_loaded = False
+        # Models are shared, so inference is serialized; waiters form the queue
+        self.inference_lock = threading.Lock()
+        self.queue_depth = 0
+        self.queue_lock = threading.Lock()
+        self.deadline_policy = DeadlinePolicy()
+        # Off unless an admin arms a capture
+        self.profiler = ProfileCapture()
     
     def load_models(self):
         """Load all pre-trained models"""
@@ -47,14 +55,11 @@ class ProductDetector:
             self.img2vec_model = Img2VecResnet18()
             print("✅ ResNet18 feature extractor loaded")
             
-            # Load pre-trained k-NN model
-            if os.path.exists('models/knn_model.pkl'):
-                model_data = joblib.load('models/knn_model.pkl')
-                self.knn_model = model_data['knn_model']
-                self.classes = model_data['classes']
-                self.embeddings = model_data['embeddings']
+            # Warm the default knowledge base; others load on first request
+            try:
+                self.knowledge_bases.get(DEFAULT_KNOWLEDGE_BASE)
                 print("✅ Pre-trained k-NN model loaded")
-            else:
+            except KeyError:
                 print("❌ Pre-trained k-NN model not found. Please run train_model.py first.")
                 return False
             
@@ -66,88 +71,168 @@ class ProductDetector:
             print(f"❌ Error loading models: {str(e)}")
             return False
     
-    def detect_products(self, image_path: str) -> List[Dict]:
-        """Detect and classify products in a shelf image"""
+    def detect_products(self, source: Union[str, Image.Image], deadline: Optional[float] = None,
+                        received_at: Optional[float] = None, source_name: Optional[str] = None,
+                        knowledge_base: str = DEFAULT_KNOWLEDGE_BASE) -> Tuple[List[Dict], Dict]:
+        """
+        Detect and classify products in a shelf image
+
+        source is an image path or an already decoded PIL image, classified
+        against the named knowledge base (loaded on first use). deadline is
+        a latency budget in seconds measured from received_at (defaults to
+        now). When set, the pipeline degrades quality in steps to stay within
+        it, and requests that cannot finish in time are rejected with 503
+        (before queueing) or 504 (after). Returns the products and a quality
+        report.
+        """
         if not self.model_loaded:
             raise HTTPException(status_code=500, detail="Models not loaded")
         
+        received_at = received_at or time.time()
+        # Resolve the knowledge base before queueing so loads don't block inference
+        try:
+            kb = self.knowledge_bases.get(knowledge_base)
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=404, detail=f"Knowledge base not found: {knowledge_base}")
+        if source_name is None:
+            source_name = Path(source).stem if isinstance(source, str) else "image0"
+
+        # Shed load up front: don't queue a request that cannot finish in time
+        with self.queue_lock:
+            if not self.deadline_policy.admits(self._remaining(deadline, received_at), self.queue_depth):
+                raise HTTPException(status_code=503, detail="Server overloaded: deadline cannot be met",
+                                    headers={"Retry-After": "1"})
+            self.queue_depth += 1
+            queue_depth = self.queue_depth
+        try:
+            with self.inference_lock:
+                # The budget may have run out while waiting for the models
+                remaining = self._remaining(deadline, received_at)
+                if remaining is not None and remaining <= 0:
+                    raise HTTPException(status_code=504, detail="Deadline exceeded while queued")
+                service_start = time.time()
+                if self.profiler.active:
+                    with self.profiler.capture():
+                        products, level = self._run_pipeline(source, source_name, kb, deadline, received_at)
+                else:
+                    products, level = self._run_pipeline(source, source_name, kb, deadline, received_at)
+                self.deadline_policy.record_service(time.time() - service_start)
+        finally:
+            with self.queue_lock:
+                self.queue_depth -= 1
+
+        elapsed = time.time() - received_at
+        quality = {
+            "level": level["level"],
+            "name": level["name"],
+            "deadline_ms": round(deadline * 1000) if deadline is not None else None,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "deadline_met": deadline is None or elapsed <= deadline,
+            "queue_depth": queue_depth
+        }
+        return products, quality
+
+    def _remaining(self, deadline: Optional[float], received_at: float) -> Optional[float]:
+        if deadline is None:
+            return None
+        return deadline - (time.time() - received_at)
+
+    def _run_pipeline(self, source: Union[str, Image.Image], source_name: str, kb: KnowledgeBase,
+                      deadline: Optional[float], received_at: float) -> Tuple[List[Dict], Dict]:
         start_time = time.time()
         
-        # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            
-            # Step 1: YOLO Object Detection
-            print("🔍 Running YOLO detection...")
-            yolo_start = time.time()
-            
-            results = self.yolo_model.predict(
-                source=image_path,
-                save=True,
-                save_crop=True,
+        # Time spent waiting in the queue already counts against the deadline
+        level = self.deadline_policy.choose_level(self._remaining(deadline, received_at))
+        
+        # Step 1: YOLO Object Detection
+        print(f"🔍 Running YOLO detection (quality: {level['name']})...")
+        yolo_start = time.time()
+        
+        predict_args = {}
+        if level["imgsz"] is not None:
+            predict_args["imgsz"] = level["imgsz"]
+        
+        with self.profiler.stage("yolo"):
+            result = self.yolo_model.predict(
+                source=source,
                 conf=0.5,
-                project=str(temp_path),
-                name="detection",
-                exist_ok=True
-            )
-            
-            yolo_time = time.time() - yolo_start
-            print(f"✅ YOLO detection completed in {yolo_time:.2f}s")
-            
-            # Step 2: Find cropped images
-            crop_dir = temp_path / "detection" / "crops" / "object"
-            if not crop_dir.exists():
-                return []
-            
-            crop_images = list(crop_dir.glob("*.jpg"))
-            print(f"📦 Found {len(crop_images)} products to classify")
-            
-            # Step 3: Classify each product
-            products = []
-            classification_start = time.time()
-            
-            for i, crop_path in enumerate(crop_images):
-                try:
-                    # Extract features
-                    from PIL import Image
-                    img = Image.open(crop_path)
+                verbose=False,
+                **predict_args
+            )[0]
+        
+        yolo_time = time.time() - yolo_start
+        print(f"✅ YOLO detection completed in {yolo_time:.2f}s")
+        
+        # Step 2: Collect detections, named the way YOLO's save_crop names files
+        boxes = result.boxes.xyxy.cpu().numpy()
+        scores = result.boxes.conf.cpu().numpy()
+        detections = [
+            {
+                "crop_id": source_name if i == 0 else f"{source_name}{i + 1}",
+                "box": [round(float(v), 1) for v in boxes[i]],
+                "detection_confidence": round(float(scores[i]), 3)
+            }
+            for i in range(len(boxes))
+        ]
+        self.deadline_policy.record_yolo(level["imgsz"], yolo_time, len(detections))
+        print(f"📦 Found {len(detections)} products to classify")
+        if not detections:
+            self.deadline_policy.record_classification(None, 0.0, 0)
+            return [], level
+        
+        # Re-check the budget now that the real crop count is known
+        level = self.deadline_policy.refine_level(
+            level, self._remaining(deadline, received_at), len(detections))
+        
+        if level["classifier"] is None:
+            print(f"⏭️ Skipping classification (quality: {level['name']})")
+            self.deadline_policy.record_classification(None, 0.0, 0)
+            return detections, level
+        
+        selected = range(len(detections))
+        if level["max_crops"] is not None:
+            # Keep the most confident detections when capping
+            selected = sorted(np.argsort(-scores, kind="stable")[:level["max_crops"]])
+        classify = kb.classify_knn if level["classifier"] == "knn" else kb.classify_centroid
+        
+        # Step 3: Classify each product
+        products = []
+        classification_start = time.time()
+        
+        for i in selected:
+            detection = detections[i]
+            try:
+                # Extract features; crop from the unrounded box like save_one_box
+                img = crop_box(result.orig_img, boxes[i])
+                with self.profiler.stage("resnet18"):
                     features = self.img2vec_model.getVec(img)
-                    img.close()
-                    
-                    # Find nearest neighbors
-                    distances, indices = self.knn_model.kneighbors([features])
-                    
-                    # Get class labels of nearest neighbors
-                    neighbor_classes = [self.classes[idx] for idx in indices[0]]
-                    
-                    # Count occurrences
-                    class_counts = Counter(neighbor_classes)
-                    
-                    # Get most common class and confidence
-                    most_common_class, count = class_counts.most_common(1)[0]
-                    confidence = count / 5.0  # 5 neighbors
-                    
-                    # Create product info
-                    product_info = {
-                        "crop_id": crop_path.stem,
-                        "product_name": most_common_class,
-                        "confidence": round(confidence, 3),
-                        "confidence_percentage": round(confidence * 100, 1)
-                    }
-                    
-                    products.append(product_info)
-                    
-                except Exception as e:
-                    print(f"❌ Error processing {crop_path}: {str(e)}")
-                    continue
-            
-            classification_time = time.time() - classification_start
-            total_time = time.time() - start_time
-            
-            print(f"✅ Classification completed in {classification_time:.2f}s")
-            print(f"⏱️ Total processing time: {total_time:.2f}s")
-            
-            return products
+                
+                with self.profiler.stage(level["classifier"]):
+                    most_common_class, confidence = classify(features)
+                
+                # Create product info
+                product_info = {
+                    **detection,
+                    "product_name": most_common_class,
+                    "confidence": round(confidence, 3),
+                    "confidence_percentage": round(confidence * 100, 1)
+                }
+                
+                products.append(product_info)
+                
+            except Exception as e:
+                print(f"❌ Error processing {detection['crop_id']}: {str(e)}")
+                continue
+        
+        classification_time = time.time() - classification_start
+        total_time = time.time() - start_time
+        self.deadline_policy.record_classification(
+            level["classifier"], classification_time, len(selected))
+        
+        print(f"✅ Classification completed in {classification_time:.2f}s")
+        print(f"⏱️ Total processing time: {total_time:.2f}s")
+        
+        return products, level
 
 # Initialize detector
 detector = ProductDetector()
@@ -176,67 +261,165 @@ async def health_check():
         "models_loaded": detector.model_loaded,
         "yolo_loaded": detector.yolo_model is not None,
         "img2vec_loaded": detector.img2vec_model is not None,
-        "knn_loaded": detector.knn_model is not None
+        "knn_loaded": detector.knowledge_bases.peek(DEFAULT_KNOWLEDGE_BASE) is not None
     }
 
+def decode_and_detect(data: bytes, deadline: Optional[float], received_at: float,
+                      source_name: Optional[str], knowledge_base: str) -> Tuple[List[Dict], Dict]:
+    """Decode an uploaded image and run detection; called from the threadpool"""
+    try:
+        image = decode_image_bytes(data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    return detector.detect_products(image, deadline, received_at, source_name, knowledge_base)
+
+async def run_detection(data: bytes, filename: Optional[str], deadline_ms: Optional[int],
+                        knowledge_base: str, received_at: float, layout: str,
+                        accept: Optional[str]) -> Response:
+    """Shared body of the detection endpoints: decode, detect, encode"""
+    if not detector.model_loaded:
+        raise HTTPException(status_code=500, detail="Models not loaded. Please check server logs.")
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"layout must be one of {', '.join(LAYOUTS)}")
+    
+    try:
+        # Decode and process off the event loop so a large image doesn't block
+        # other requests and queued requests stay visible
+        deadline = deadline_ms / 1000.0 if deadline_ms is not None else None
+        source_name = Path(filename).stem if filename else None
+        products, quality = await run_in_threadpool(
+            decode_and_detect, data, deadline, received_at, source_name, knowledge_base)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+    
+    return build_detection_response(products, quality, filename, knowledge_base,
+                                    time.time(), layout, accept)
+
 @app.post("/detect-products")
-async def detect_products(file: UploadFile = File(...)):
+async def detect_products(file: UploadFile = File(...), deadline_ms: Optional[int] = Form(None, gt=0),
+                          knowledge_base: str = Form(DEFAULT_KNOWLEDGE_BASE), layout: str = "rows",
+                          accept: Optional[str] = Header(None)):
     """
     Detect and classify products in a shelf image
     
+    knowledge_base names the store catalog to classify against.
+    Optional deadline_ms sets a latency budget; under load the pipeline
+    degrades quality to meet it and reports the level applied.
+    layout=columnar returns parallel arrays instead of one object per
+    product; Accept: application/msgpack returns MessagePack.
+    
     Returns:
     - List of detected products with names and confidence scores
     """
-    if not detector.model_loaded:
-        raise HTTPException(status_code=500, detail="Models not loaded. Please check server logs.")
+    received_at = time.time()
     
     # Validate file type
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_path = tmp_file.name
-        
-        # Process the image
-        products = detector.detect_products(tmp_path)
-        
-        # Clean up temporary file
-        os.unlink(tmp_path)
-        
-        # Prepare response
-        response = {
-            "success": True,
-            "total_products": len(products),
-            "products": products,
-            "processing_info": {
-                "input_filename": file.filename,
-                "timestamp": time.time()
-            }
-        }
-        print("response", products)
+    data = await file.read()
+    return await run_detection(data, file.filename, deadline_ms, knowledge_base,
+                               received_at, layout, accept)
 
-        return JSONResponse(content=response)
-        
-    except Exception as e:
-        # Clean up temporary file if it exists
-        if 'tmp_path' in locals() and os.path.exists(tmp_path):
-            os.unlink(tmp_path)
-        
-        raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+@app.post("/detect-products/raw")
+async def detect_products_raw(request: Request, deadline_ms: Optional[int] = Query(None, gt=0),
+                              knowledge_base: str = DEFAULT_KNOWLEDGE_BASE,
+                              filename: Optional[str] = None, layout: str = "rows",
+                              accept: Optional[str] = Header(None)):
+    """
+    Detect and classify products in an image sent as the raw request body
+    
+    Skips multipart parsing: send the encoded image with Content-Type
+    application/octet-stream or image/*. Options are query parameters and
+    otherwise match /detect-products.
+    """
+    received_at = time.time()
+    
+    # Validate body type
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if not (content_type == "application/octet-stream" or content_type.startswith("image/")):
+        raise HTTPException(status_code=415, detail="Body must be application/octet-stream or image/*")
+    
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty request body")
+    return await run_detection(data, filename, deadline_ms, knowledge_base,
+                               received_at, layout, accept)
 
 @app.get("/model-info")
-async def get_model_info():
+async def get_model_info(knowledge_base: str = DEFAULT_KNOWLEDGE_BASE):
     """Get information about loaded models"""
+    # Report on a cached knowledge base without forcing a load
+    kb = detector.knowledge_bases.peek(knowledge_base)
     return {
         "yolo_model": "YOLOv8 (best.pt)" if detector.yolo_model else None,
         "feature_extractor": "ResNet18" if detector.img2vec_model else None,
-        "classifier": "k-NN" if detector.knn_model else None,
-        "knowledge_base_classes": detector.classes if detector.classes else [],
-        "knowledge_base_size": len(detector.classes) if detector.classes else 0
+        "classifier": "k-NN" if kb else None,
+        "knowledge_base": knowledge_base,
+        "knowledge_base_classes": kb.centroid_classes if kb else [],
+        "knowledge_base_size": len(kb.classes) if kb else 0
     }
 
+@app.get("/knowledge-bases")
+async def get_knowledge_bases():
+    """Knowledge base cache usage, per-KB load times and hit rates"""
+    return detector.knowledge_bases.stats()
+
+def check_admin(token: Optional[str]):
+    """Reject admin calls without the configured token; admin is disabled when none is set"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile")
+async def start_profile(mode: str = "torch", requests: Optional[int] = None,
+                        seconds: Optional[float] = None,
+                        x_admin_token: Optional[str] = Header(None)):
+    """
+    Start capturing profiles for the next N requests and/or T seconds
+    
+    mode=torch records operator timings and Python stacks with the torch
+    profiler; mode=sampling samples Python stacks with lower overhead.
+    """
+    check_admin(x_admin_token)
+    try:
+        return detector.profiler.start(mode, requests, seconds)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.delete("/admin/profile")
+async def stop_profile(x_admin_token: Optional[str] = Header(None)):
+    """Stop the current capture early, keeping what was recorded"""
+    check_admin(x_admin_token)
+    return detector.profiler.stop()
+
+@app.get("/admin/profile")
+async def get_profile_status(x_admin_token: Optional[str] = Header(None)):
+    """Capture status and per-stage (yolo, resnet18, knn/centroid) timings"""
+    check_admin(x_admin_token)
+    return detector.profiler.status()
+
+@app.get("/admin/profile/trace")
+async def download_profile_trace(x_admin_token: Optional[str] = Header(None)):
+    """Captured torch profiler events as a Chrome/Perfetto trace file"""
+    check_admin(x_admin_token)
+    trace = detector.profiler.chrome_trace()
+    if not trace["traceEvents"]:
+        raise HTTPException(status_code=404, detail="No torch trace captured")
+    return Response(content=orjson.dumps(trace), media_type="application/json",
+                    headers={"Content-Disposition": 'attachment; filename="trace.json"'})
+
+@app.get("/admin/profile/stacks")
+async def download_profile_stacks(x_admin_token: Optional[str] = Header(None)):
+    """Collapsed stacks, ready for flamegraph.pl or speedscope"""
+    check_admin(x_admin_token)
+    return PlainTextResponse(detector.profiler.collapsed_stacks(),
+                             headers={"Content-Disposition": 'attachment; filename="stacks.txt"'})
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=3000)
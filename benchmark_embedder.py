@@ -0,0 +1,130 @@
+"""
+Measure allocations and peak memory of the ResNet18 embedding hot loop.
+Compares the previous getVec implementation (per-call zeros tensor, forward
+hook, ToTensor + Normalize, autograd enabled) with the current one.
+
+Each variant runs in its own process so peak RSS is not shared between them.
+"""
+
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from PIL import Image
+from torch.profiler import profile, ProfilerActivity
+
+from src.img2vec_resnet18 import Img2VecResnet18
+
+DATA_PATH = 'data/knowledge_base/crops/object'
+VARIANTS = ("legacy", "current")
+
+
+def legacy_get_vec(img2vec, img):
+    """The getVec implementation before buffers were made reusable"""
+    image = img2vec.normalize(img2vec.toTensor(img)).unsqueeze(0).to(img2vec.device)
+    embedding = torch.zeros(1, img2vec.numberFeatures, 1, 1)
+
+    def copyData(m, i, o):
+        embedding.copy_(o.data)
+
+    h = img2vec.featureLayer.register_forward_hook(copyData)
+    img2vec.model(image)
+    h.remove()
+    return embedding.numpy()[0, :, 0, 0]
+
+
+def torch_allocations(fn, images):
+    """
+    Torch CPU allocator activity from the profiler's [memory] events: one
+    event per allocation (positive Bytes) or free (negative Bytes), each
+    carrying the running allocated total.
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for img in images:
+            fn(img)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        trace_path = os.path.join(temp_dir, "trace.json")
+        prof.export_chrome_trace(trace_path)
+        with open(trace_path) as f:
+            events = [e for e in json.load(f)["traceEvents"] if e.get("name") == "[memory]"]
+
+    allocations = [e["args"]["Bytes"] for e in events if e["args"]["Bytes"] > 0]
+    if events:
+        first = events[0]["args"]
+        baseline = first["Total Allocated"] - first["Bytes"]
+        peak = max(e["args"]["Total Allocated"] for e in events) - baseline
+    else:
+        peak = 0
+    return len(allocations), sum(allocations), peak
+
+
+def run_variant(variant):
+    """Benchmark one variant in this process and print its results as JSON"""
+    paths = sorted(glob.glob(f"{DATA_PATH}/**/*.jpg"))
+    images = []
+    for path in paths:
+        with Image.open(path) as img:
+            images.append(img.convert("RGB"))
+
+    torch.set_num_threads(1)
+    img2vec = Img2VecResnet18()
+    if variant == "legacy":
+        fn = lambda img: legacy_get_vec(img2vec, img)
+    else:
+        fn = img2vec.getVec
+
+    # Warm up so one-off buffer growth and lazy init are not counted
+    for img in images:
+        fn(img)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    for img in images:
+        fn(img)
+    elapsed = time.time() - start
+    # Read RSS before profiling, which has a large footprint of its own
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    count, total_bytes, peak = torch_allocations(fn, images)
+
+    print(json.dumps({
+        "crops": len(images),
+        "ms_per_crop": elapsed / len(images) * 1000,
+        "allocations_per_crop": count / len(images),
+        "kb_allocated_per_crop": total_bytes / len(images) / 1024,
+        "peak_torch_kb": peak / 1024,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": rss_after / 1024,
+        "rss_growth_after_warmup_kb": rss_after - rss_before
+    }))
+
+
+def main():
+    """Benchmark legacy and current embedding paths on the knowledge base crops"""
+    if not glob.glob(f"{DATA_PATH}/**/*.jpg"):
+        raise ValueError(f"No crops found under {DATA_PATH}")
+
+    print("🚀 Benchmarking embedder on the knowledge base crops (1 thread)")
+    for variant in VARIANTS:
+        result = subprocess.run([sys.executable, __file__, "--variant", variant],
+                                capture_output=True, text=True, check=True)
+        stats = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"\n📊 {variant} getVec ({stats['crops']} crops)")
+        print(f"   ⏱️  {stats['ms_per_crop']:.2f} ms per crop")
+        print(f"   🧮 Torch allocations per crop: {stats['allocations_per_crop']:.1f}")
+        print(f"   📦 Torch bytes allocated per crop: {stats['kb_allocated_per_crop']:.1f} KB")
+        print(f"   📈 Peak torch allocated (profiled pass): {stats['peak_torch_kb']:.1f} KB")
+        print(f"   🐏 Peak RSS: {stats['peak_rss_mb']:.1f} MB "
+              f"(+{stats['rss_growth_after_warmup_kb']} KB after warm-up)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--variant":
+        run_variant(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,366 @@
+"""
+Offline bulk processing of stored shelf photos.
+Runs ProductDetector directly (no HTTP) over a directory or manifest of
+images with a pool of worker processes, writes results incrementally to
+JSONL or Parquet and checkpoints progress so a killed job can resume.
+
+Usage:
+    python bulk_process.py data/archive --output results.jsonl
+    python bulk_process.py manifest.txt --output results_parquet --format parquet --workers 4
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+YOLO_MODEL_FILE = "models/best.pt"
+
+# Per-process detector, created by the pool initializer
+_detector = None
+
+
+def _init_worker(model_dir: str, threads: int):
+    """Load one set of models per worker process"""
+    global _detector
+    import torch
+    torch.set_num_threads(threads)
+
+    # Model paths in app.py are relative to the project directory
+    os.chdir(model_dir)
+    from app import ProductDetector
+    _detector = ProductDetector()
+    with contextlib.redirect_stdout(io.StringIO()):
+        loaded = _detector.load_models()
+    if not loaded:
+        raise RuntimeError("Models failed to load in worker. Run check_setup.py.")
+
+
+def _process_image(task: Tuple[str, str]) -> Dict:
+    """Decode, detect, embed and classify one image inside a worker"""
+    path, knowledge_base = task
+    from src.image_io import decode_image_bytes
+    start = time.time()
+    try:
+        image = decode_image_bytes(Path(path).read_bytes())
+        # The detector logs every stage; keep worker output quiet
+        with contextlib.redirect_stdout(io.StringIO()):
+            products, quality = _detector.detect_products(image, source_name=Path(path).stem,
+                                                          knowledge_base=knowledge_base)
+        return {
+            "image": path,
+            "total_products": len(products),
+            "products": products,
+            "quality": quality["name"],
+            "elapsed_ms": round((time.time() - start) * 1000, 1)
+        }
+    except Exception as e:
+        return {"image": path, "error": str(e)}
+
+
+def check_models(model_dir: Path, knowledge_base: str):
+    """Fail fast in the parent if the workers could not load their models"""
+    from src.knowledge_base import knowledge_base_path
+    try:
+        kb_file = knowledge_base_path(knowledge_base)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+    for required in (kb_file, YOLO_MODEL_FILE):
+        if not (model_dir / required).exists():
+            raise SystemExit(f"❌ Missing {required}. Run check_setup.py (and train_model.py for knowledge bases).")
+
+
+def list_images(source: Path) -> List[str]:
+    """Images under a directory (recursive) or listed one per line in a manifest file"""
+    if source.is_dir():
+        paths = [p for p in source.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS]
+    else:
+        with open(source) as f:
+            lines = [line.strip() for line in f]
+        # Manifest entries are relative to the manifest's directory
+        paths = [(source.parent / line) for line in lines if line and not line.startswith("#")]
+    return sorted(str(p.resolve()) for p in paths)
+
+
+class JsonlWriter:
+    """Appends one JSON object per successfully processed image to a single file"""
+
+    def __init__(self, output: Path):
+        self.output = output
+
+    def resume(self, state: Dict):
+        # Drop anything written after the last checkpoint (e.g. a partial batch)
+        if self.output.exists():
+            with open(self.output, "r+b") as f:
+                f.truncate(state.get("output_bytes", 0))
+
+    def write(self, records: List[Dict]) -> Dict:
+        with open(self.output, "ab") as f:
+            for record in records:
+                f.write(json.dumps(record).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+            return {"output_bytes": f.tell()}
+
+
+class ParquetWriter:
+    """
+    Writes one part file per batch, one row per detected product. An image
+    with no detections gets a single row with null product columns, so every
+    processed image appears in the output.
+    """
+
+    def __init__(self, output: Path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (run: pip install pyarrow)")
+        self.pa = pa
+        self.pq = pq
+        self.output = output
+        self.next_part = 0
+        self.schema = pa.schema([
+            ("image", pa.string()),
+            ("crop_id", pa.string()),
+            ("x1", pa.float32()),
+            ("y1", pa.float32()),
+            ("x2", pa.float32()),
+            ("y2", pa.float32()),
+            ("detection_confidence", pa.float32()),
+            ("product_name", pa.string()),
+            ("confidence", pa.float32()),
+            ("quality", pa.string())
+        ])
+
+    def resume(self, state: Dict):
+        self.output.mkdir(parents=True, exist_ok=True)
+        self.next_part = state.get("next_part", 0)
+        # Remove parts written after the last checkpoint
+        for part in self.output.glob("part-*.parquet"):
+            if int(part.stem.split("-")[1]) >= self.next_part:
+                part.unlink()
+
+    def write(self, records: List[Dict]) -> Dict:
+        rows = []
+        for record in records:
+            if not record["products"]:
+                rows.append({"image": record["image"], "quality": record["quality"]})
+            for product in record["products"]:
+                x1, y1, x2, y2 = product["box"]
+                rows.append({
+                    "image": record["image"],
+                    "crop_id": product["crop_id"],
+                    "x1": x1, "y1": y1, "x2": x2, "y2": y2,
+                    "detection_confidence": product["detection_confidence"],
+                    "product_name": product.get("product_name"),
+                    "confidence": product.get("confidence"),
+                    "quality": record["quality"]
+                })
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        self.pq.write_table(table, self.output / f"part-{self.next_part:05d}.parquet")
+        self.next_part += 1
+        return {"next_part": self.next_part}
+
+
+def load_checkpoint(checkpoint: Path) -> Tuple[Set[str], Dict, Optional[Dict]]:
+    """
+    Read the append-only checkpoint log: completed images, the last writer
+    state and the run parameters recorded on its first line. A torn trailing
+    line (job killed mid-write) is cut off so later commits start on a clean
+    line.
+    """
+    completed = set()
+    state = {}
+    params = None
+    if not checkpoint.exists():
+        return completed, state, params
+    valid_bytes = 0
+    with open(checkpoint, "r+b") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("unterminated line")
+                entry = json.loads(line)
+            except ValueError:
+                # That batch never committed; drop it and anything after it
+                f.truncate(valid_bytes)
+                break
+            valid_bytes += len(line)
+            if "params" in entry:
+                params = entry["params"]
+                continue
+            completed.update(entry["images"])
+            state = entry["state"]
+    return completed, state, params
+
+
+def _append_entry(checkpoint: Path, entry: Dict):
+    with open(checkpoint, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def append_run_params(checkpoint: Path, params: Dict):
+    """Record the options a checkpoint's results were produced with"""
+    _append_entry(checkpoint, {"params": params})
+
+
+def append_checkpoint(checkpoint: Path, images: Iterable[str], state: Dict):
+    """Commit a batch: only after this line is durable is the batch considered done"""
+    _append_entry(checkpoint, {"images": list(images), "state": state})
+
+
+def append_errors(errors_file: Path, records: List[Dict]):
+    """Log failed images next to the output; they stay pending and are retried on resume"""
+    with open(errors_file, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def commit_batch(batch: List[Dict], writer, checkpoint: Path, errors_file: Path):
+    """Write a batch's results, then checkpoint only the images that succeeded"""
+    succeeded = [record for record in batch if "error" not in record]
+    failed = [record for record in batch if "error" in record]
+    if failed:
+        append_errors(errors_file, failed)
+    append_checkpoint(checkpoint, [r["image"] for r in succeeded], writer.write(succeeded))
+
+
+def has_existing_output(output: Path) -> bool:
+    if output.is_dir():
+        return any(output.glob("part-*.parquet"))
+    return output.exists() and output.stat().st_size > 0
+
+
+def bulk_process(source: Path, output: Path, fmt: str, workers: int, batch_size: int,
+                 knowledge_base: str = "default", overwrite: bool = False):
+    """Process every pending image, checkpointing after each written batch"""
+    print("🚀 Starting bulk processing...")
+    images = list_images(source)
+    print(f"📚 Found {len(images)} images")
+
+    checkpoint = Path(str(output) + ".checkpoint")
+    errors_file = Path(str(output) + ".errors.jsonl")
+    if not checkpoint.exists() and has_existing_output(output):
+        # Without a checkpoint we can't tell which results are valid
+        if not overwrite:
+            raise SystemExit(f"❌ {output} already exists and has no checkpoint. "
+                             "Pass --overwrite to replace it.")
+        print(f"⚠️  Overwriting existing results in {output}")
+    run_params = {"format": fmt, "knowledge_base": knowledge_base}
+    completed, state, checkpoint_params = load_checkpoint(checkpoint)
+    if checkpoint_params is not None and checkpoint_params != run_params:
+        # Resuming would mix catalogs or hand one writer the other's state
+        recorded = ", ".join(f"{key}={value}" for key, value in checkpoint_params.items())
+        raise SystemExit(f"❌ {output} was started with {recorded}. "
+                         "Resume with the same options or choose a new --output.")
+
+    model_dir = Path(__file__).resolve().parent
+    check_models(model_dir, knowledge_base)
+
+    if not checkpoint.exists() and errors_file.exists():
+        errors_file.unlink()
+    writer = ParquetWriter(output) if fmt == "parquet" else JsonlWriter(output)
+    writer.resume(state)
+    if checkpoint_params is None:
+        append_run_params(checkpoint, run_params)
+
+    pending = [path for path in images if path not in completed]
+    if completed:
+        print(f"♻️  Resuming: {len(completed)} already done, {len(pending)} remaining")
+    if not pending:
+        print("✅ Nothing to do")
+        return
+
+    # Split the CPU between workers so they don't oversubscribe each other
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    start_time = time.time()
+    processed = 0
+    failed = 0
+    batch = []
+
+    # spawn avoids forking a parent that already has torch threads running.
+    # Unlike multiprocessing.Pool, the executor breaks instead of respawning
+    # workers forever when their initializer fails.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(str(model_dir), threads)) as pool:
+        # Workers decode, detect and classify different images concurrently,
+        # so the stages of consecutive images overlap
+        futures = [pool.submit(_process_image, (path, knowledge_base)) for path in pending]
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                batch.append(record)
+                if "error" in record:
+                    failed += 1
+                    print(f"❌ Error processing {record['image']}: {record['error']}")
+
+                if len(batch) >= batch_size:
+                    commit_batch(batch, writer, checkpoint, errors_file)
+                    processed += len(batch)
+                    batch = []
+                    rate = processed / (time.time() - start_time)
+                    print(f"   Processed {processed}/{len(pending)} images ({rate:.2f} images/sec)")
+        except BrokenProcessPool:
+            for future in futures:
+                future.cancel()
+            raise SystemExit("❌ Worker processes failed to load models or crashed. "
+                             "Completed batches are checkpointed; fix the cause and rerun to resume.")
+
+        if batch:
+            commit_batch(batch, writer, checkpoint, errors_file)
+            processed += len(batch)
+
+    total_time = time.time() - start_time
+    print("\n" + "="*50)
+    print("📊 BULK PROCESSING SUMMARY")
+    print("="*50)
+    print(f"⏱️  Total time: {total_time:.2f}s")
+    print(f"🖼️  Images processed: {processed} ({failed} failed)")
+    print(f"⚡ Throughput: {processed / total_time:.2f} images/sec")
+    print(f"📁 Results: {output}")
+    if failed:
+        print(f"⚠️  Failures logged to {errors_file}; rerun to retry them")
+    print("="*50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run product detection over an image archive")
+    parser.add_argument("source", type=Path, help="Directory of images or manifest file (one path per line)")
+    parser.add_argument("--output", type=Path, required=True, help="JSONL file or Parquet directory")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes (each loads its own models)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per write/checkpoint")
+    parser.add_argument("--knowledge-base", default="default", help="Knowledge base to classify against")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Replace existing output that has no checkpoint")
+    args = parser.parse_args()
+
+    if not args.source.exists():
+        print(f"❌ Source not found: {args.source}")
+        sys.exit(1)
+
+    bulk_process(args.source, args.output.resolve(), args.format, args.workers, args.batch_size,
+                 args.knowledge_base, args.overwrite)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n🛑 Stopped by user. Run the same command again to resume.")
+        sys.exit(1)
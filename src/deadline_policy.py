@@ -0,0 +1,125 @@
+"""
+Deadline-aware quality degradation for the detection pipeline.
+
+Each request may carry a latency budget. Before and during processing the
+policy estimates how long each quality level would take (using running
+averages of observed stage timings plus the time already spent queueing)
+and picks the best level that still fits the remaining budget.
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+# Quality levels, best first. Each step trades accuracy for latency:
+#   imgsz      - YOLO input size (None keeps the model default)
+#   max_crops  - cap on the number of crops classified (None = no cap)
+#   classifier - "knn", "centroid", or None for detection-only output
+QUALITY_LEVELS: List[Dict] = [
+    {"level": 0, "name": "full", "imgsz": None, "max_crops": None, "classifier": "knn"},
+    {"level": 1, "name": "reduced_input", "imgsz": 480, "max_crops": None, "classifier": "knn"},
+    {"level": 2, "name": "capped_crops", "imgsz": 480, "max_crops": 40, "classifier": "knn"},
+    {"level": 3, "name": "centroid_only", "imgsz": 320, "max_crops": 40, "classifier": "centroid"},
+    {"level": 4, "name": "detection_only", "imgsz": 320, "max_crops": None, "classifier": None},
+]
+
+# Input size YOLO runs at when no imgsz is passed
+DEFAULT_IMGSZ = 640
+
+# Seed per-crop classification times (seconds), conservative CPU guesses
+SEED_CROP_SECONDS = {"knn": 0.15, "centroid": 0.12}
+
+
+class DeadlinePolicy:
+    def __init__(self, smoothing: float = 0.2, safety_margin: float = 0.9, decay: float = 0.05):
+        # Weight given to each new observation in the running averages
+        self.smoothing = smoothing
+        # Fraction of the remaining budget we are willing to plan against
+        self.safety_margin = safety_margin
+        # Per-request pull of unobserved classifier estimates back toward their
+        # seeds, so one slow burst cannot pin the server at a degraded level
+        self.decay = decay
+        # Running averages, seeded with conservative CPU guesses
+        self.yolo_seconds_at_default = 1.0
+        self.crop_seconds = dict(SEED_CROP_SECONDS)
+        self.crops_per_image = 30.0
+        # Time one request holds the models, used to price the queue ahead
+        self.service_seconds = 1.0
+        self._lock = threading.Lock()
+
+    def _ewma(self, old: float, new: float) -> float:
+        return (1 - self.smoothing) * old + self.smoothing * new
+
+    def estimate_yolo(self, imgsz: Optional[int]) -> float:
+        """Estimated YOLO time, scaled by input area relative to the default size"""
+        size = imgsz or DEFAULT_IMGSZ
+        return self.yolo_seconds_at_default * (size / DEFAULT_IMGSZ) ** 2
+
+    def estimate_classification(self, level: Dict, num_crops: float) -> float:
+        """Estimated classification time for a level and a given crop count"""
+        if level["classifier"] is None:
+            return 0.0
+        if level["max_crops"] is not None:
+            num_crops = min(num_crops, level["max_crops"])
+        return num_crops * self.crop_seconds[level["classifier"]]
+
+    def choose_level(self, remaining: Optional[float]) -> Dict:
+        """Pick the best level whose full-pipeline estimate fits the remaining budget"""
+        if remaining is None:
+            return QUALITY_LEVELS[0]
+        budget = remaining * self.safety_margin
+        for level in QUALITY_LEVELS:
+            estimate = (self.estimate_yolo(level["imgsz"])
+                        + self.estimate_classification(level, self.crops_per_image))
+            if estimate <= budget:
+                return level
+        return QUALITY_LEVELS[-1]
+
+    def refine_level(self, level: Dict, remaining: Optional[float], num_crops: int) -> Dict:
+        """
+        Re-check after detection, when the real crop count is known.
+        Only ever degrades further; YOLO input size is already spent.
+        """
+        if remaining is None:
+            return level
+        budget = remaining * self.safety_margin
+        for candidate in QUALITY_LEVELS[level["level"]:]:
+            if self.estimate_classification(candidate, num_crops) <= budget:
+                return candidate
+        return QUALITY_LEVELS[-1]
+
+    def record_yolo(self, imgsz: Optional[int], seconds: float, num_crops: int):
+        """Feed an observed YOLO timing back into the running averages"""
+        size = imgsz or DEFAULT_IMGSZ
+        normalized = seconds * (DEFAULT_IMGSZ / size) ** 2
+        with self._lock:
+            self.yolo_seconds_at_default = self._ewma(self.yolo_seconds_at_default, normalized)
+            self.crops_per_image = self._ewma(self.crops_per_image, num_crops)
+
+    def record_classification(self, classifier: Optional[str], seconds: float, num_crops: int):
+        """
+        Feed an observed per-crop classification timing back into the running
+        averages. Call once per request, with classifier None when nothing was
+        classified; estimates for classifiers that did not run decay toward
+        their seeds.
+        """
+        with self._lock:
+            for name, seed in SEED_CROP_SECONDS.items():
+                if name == classifier and num_crops > 0:
+                    self.crop_seconds[name] = self._ewma(self.crop_seconds[name], seconds / num_crops)
+                else:
+                    self.crop_seconds[name] += self.decay * (seed - self.crop_seconds[name])
+
+    def record_service(self, seconds: float):
+        """Feed back how long a request held the models"""
+        with self._lock:
+            self.service_seconds = self._ewma(self.service_seconds, seconds)
+
+    def admits(self, remaining: Optional[float], requests_ahead: int) -> bool:
+        """
+        Whether a request can still finish in time behind requests_ahead others.
+        With an empty queue anything with budget left is admitted, so the
+        estimates keep being refreshed by real traffic.
+        """
+        if remaining is None:
+            return True
+        return remaining > 0 and requests_ahead * self.service_seconds < remaining
@@ -0,0 +1,38 @@
+"""
+In-memory image helpers for the detection pipeline
+"""
+
+import io
+from typing import Sequence
+
+import numpy as np
+from PIL import Image
+
+
+def decode_image_bytes(data: bytes) -> Image.Image:
+    """Decode an encoded image (JPEG, PNG, ...) straight from memory into RGB"""
+    img = Image.open(io.BytesIO(data))
+    # Force the decode now so a corrupt upload fails here, not inside YOLO
+    img.load()
+    return img.convert("RGB")
+
+
+def crop_box(orig_bgr: np.ndarray, xyxy: Sequence[float], gain: float = 1.02, pad: int = 10) -> Image.Image:
+    """
+    Cut a detection out of the original frame as an RGB PIL image.
+
+    Mirrors the box expansion YOLO's save_crop applies (gain and pad), so
+    crops match what the knowledge base was built from, without the JPEG
+    round trip through disk.
+    """
+    x1, y1, x2, y2 = (float(v) for v in xyxy)
+    # Expand the box around its center
+    cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+    w, h = (x2 - x1) * gain + pad, (y2 - y1) * gain + pad
+    height, width = orig_bgr.shape[:2]
+    left = int(np.clip(cx - w / 2, 0, width))
+    right = int(np.clip(cx + w / 2, 0, width))
+    top = int(np.clip(cy - h / 2, 0, height))
+    bottom = int(np.clip(cy + h / 2, 0, height))
+    # BGR -> RGB; copy so the crop does not pin the full frame in memory
+    return Image.fromarray(np.ascontiguousarray(orig_bgr[top:bottom, left:right, ::-1]))
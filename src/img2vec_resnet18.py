@@ -1,10 +1,15 @@
+import numpy as np
 import torch
 from tqdm import tqdm
 from torchvision import models
 from torchvision import transforms
 
+# ImageNet statistics the ResNet18 weights were trained with
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
 class Img2VecResnet18():
-    def __init__(self):
+    def __init__(self, maxPixels=512 * 512):
         # Set the device to CPU
         self.device = torch.device("cpu")
         # Define the number of features extracted by the model
@@ -17,30 +22,56 @@ class Img2VecResnet18():
         self.model = self.model.to(self.device)
         # Set the model to evaluation mode
         self.model.eval()
-        # Initialize the transformation to convert images to tensors
+        # Kept for callers that still want the torchvision transforms
         self.toTensor = transforms.ToTensor()
-        # Initialize the normalization transformation for image tensors
-        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        self.normalize = transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+        # ToTensor (x / 255) and Normalize ((x - mean) / std) folded into a
+        # single multiply-add: x * scale + shift
+        std = torch.tensor(IMAGENET_STD).view(3, 1, 1)
+        mean = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+        self.normScale = 1.0 / (255.0 * std)
+        self.normShift = -mean / std
+        # Reusable input buffer. Crops are embedded at native resolution, so
+        # it is sized in pixels and only grows when a larger crop arrives
+        self.inputBuffer = torch.empty(3 * maxPixels, dtype=torch.float32, device=self.device)
+        # Reusable pooled-feature buffer; global average pooling writes into it
+        self.outputBuffer = torch.empty(1, self.numberFeatures, dtype=torch.float32, device=self.device)
 
     def getVec(self, img):
-        # Convert the image to a tensor and normalize it
-        image = self.normalize(self.toTensor(img)).unsqueeze(0).to(self.device)
-        # Create a tensor for storing the feature embedding
-        embedding = torch.zeros(1, self.numberFeatures, 1, 1)
-
-        def copyData(m, i, o):
-            # Function to copy the output tensor to the embedding tensor
-            embedding.copy_(o.data)
-
-        # Register a forward hook to the feature layer
-        h = self.featureLayer.register_forward_hook(copyData)
-        # Pass the image through the model
-        self.model(image)
-        # Remove the forward hook
-        h.remove()
-
-        # Convert the embedding tensor to a numpy array and return it
-        return embedding.numpy()[0, :, 0, 0]
+        # The normalization below assumes 3 channels
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # PIL hands out a copy of its pixels; this is the one per-call host allocation
+        pixels = np.asarray(img)
+        height, width = pixels.shape[:2]
+
+        # Grow the input buffer only if this crop does not fit
+        needed = 3 * height * width
+        if needed > self.inputBuffer.numel():
+            self.inputBuffer = torch.empty(needed, dtype=torch.float32, device=self.device)
+        image = self.inputBuffer[:needed].view(1, 3, height, width)
+
+        # Write HWC uint8 pixels into the CHW float buffer in one conversion,
+        # then normalize in place
+        np.copyto(image.numpy()[0], pixels.transpose(2, 0, 1))
+        torch.addcmul(self.normShift, image, self.normScale, out=image)
+
+        # Run the backbone without recording autograd state; intermediate
+        # activations are still allocated by the convolution layers
+        with torch.no_grad():
+            self.forwardFeatures(image)
+
+        # outputBuffer is reused on the next call, so hand callers a copy
+        return self.outputBuffer.numpy()[0].copy()
+
+    def forwardFeatures(self, image):
+        # ResNet18 up to the feature layer, pooling straight into outputBuffer
+        m = self.model
+        x = m.maxpool(m.relu(m.bn1(m.conv1(image))))
+        x = m.layer4(m.layer3(m.layer2(m.layer1(x))))
+        # Equivalent to the adaptive (1, 1) average pool + flatten
+        torch.mean(x, dim=(2, 3), out=self.outputBuffer)
+        return self.outputBuffer
 
     def getFeatureLayer(self):
         # Create an instance of the ResNet-18 model
@@ -0,0 +1,189 @@
+"""
+Knowledge bases (k-NN indexes over product embeddings) and a memory-bounded
+LRU cache of them, so one server can host many store catalogs while sharing
+the YOLO and ResNet18 models.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Tuple
+
+import joblib
+import numpy as np
+
+DEFAULT_KNOWLEDGE_BASE = "default"
+# The default knowledge base keeps its original location for compatibility
+DEFAULT_MODEL_FILE = "models/knn_model.pkl"
+KNOWLEDGE_BASE_DIR = "models/knowledge_bases"
+
+# Names become file names, so keep them to a safe character set
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def knowledge_base_path(name: str) -> str:
+    """File a knowledge base is stored in"""
+    if name == DEFAULT_KNOWLEDGE_BASE:
+        return DEFAULT_MODEL_FILE
+    if not _NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid knowledge base name: {name!r}")
+    return os.path.join(KNOWLEDGE_BASE_DIR, f"{name}.pkl")
+
+
+class KnowledgeBase:
+    def __init__(self, name: str, model_data: Dict):
+        self.name = name
+        self.knn_model = model_data['knn_model']
+        self.classes = model_data['classes']
+        self.embeddings = model_data['embeddings']
+        self.n_neighbors = model_data.get('n_neighbors', 5)
+        self.build_centroids()
+
+    @classmethod
+    def load(cls, name: str) -> "KnowledgeBase":
+        path = knowledge_base_path(name)
+        if not os.path.exists(path):
+            raise KeyError(name)
+        return cls(name, joblib.load(path))
+
+    def build_centroids(self):
+        """Precompute one L2-normalized mean embedding per class for the degraded classifier"""
+        classes = np.asarray(self.classes)
+        embeddings = np.asarray(self.embeddings, dtype=np.float32)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.centroid_classes = sorted(set(classes.tolist()))
+        centroids = np.stack([embeddings[classes == c].mean(axis=0) for c in self.centroid_classes])
+        self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate resident size: embeddings, the index's copy of them, labels and centroids"""
+        total = np.asarray(self.embeddings).nbytes + np.asarray(self.classes).nbytes + self.centroids.nbytes
+        fit_x = getattr(self.knn_model, "_fit_X", None)
+        if fit_x is not None and fit_x is not self.embeddings:
+            total += fit_x.nbytes
+        return total
+
+    def classify_knn(self, features: np.ndarray) -> Tuple[str, float]:
+        """Majority vote over the k nearest knowledge-base embeddings"""
+        # Find nearest neighbors
+        distances, indices = self.knn_model.kneighbors([features])
+
+        # Get class labels of nearest neighbors
+        neighbor_classes = [self.classes[idx] for idx in indices[0]]
+
+        # Count occurrences
+        class_counts = Counter(neighbor_classes)
+
+        # Get most common class and confidence
+        most_common_class, count = class_counts.most_common(1)[0]
+        confidence = count / float(self.n_neighbors)
+        return most_common_class, confidence
+
+    def classify_centroid(self, features: np.ndarray) -> Tuple[str, float]:
+        """Nearest class centroid by cosine similarity"""
+        query = features / np.linalg.norm(features)
+        similarities = self.centroids @ query
+        best = int(np.argmax(similarities))
+        return self.centroid_classes[best], float(max(similarities[best], 0.0))
+
+
+class KnowledgeBaseCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        # name -> KnowledgeBase, least recently used first
+        self._entries = OrderedDict()
+        # name -> {"hits", "misses", "loads", "last_load_seconds", "total_load_seconds"}
+        self._stats = {}
+        self._lock = threading.Lock()
+        # One lock per name so concurrent misses for the same KB load it once
+        self._load_locks = {}
+
+    def _stats_for(self, name: str) -> Dict:
+        return self._stats.setdefault(name, {
+            "hits": 0, "misses": 0, "loads": 0,
+            "last_load_seconds": None, "total_load_seconds": 0.0
+        })
+
+    def get(self, name: str) -> KnowledgeBase:
+        """Return a knowledge base, loading it on first use. Raises KeyError if it does not exist."""
+        path = knowledge_base_path(name)
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                self._stats_for(name)["hits"] += 1
+                return self._entries[name]
+        # Unknown names get no per-name state, so clients can't grow it
+        if not os.path.exists(path):
+            raise KeyError(name)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        try:
+            with load_lock:
+                # Another request may have loaded it while we waited
+                with self._lock:
+                    if name in self._entries:
+                        self._entries.move_to_end(name)
+                        self._stats_for(name)["hits"] += 1
+                        return self._entries[name]
+
+                start = time.time()
+                kb = KnowledgeBase.load(name)
+                load_seconds = time.time() - start
+                print(f"📚 Knowledge base '{name}' loaded in {load_seconds:.2f}s ({kb.nbytes / 1024 / 1024:.1f} MB)")
+
+                with self._lock:
+                    stats = self._stats_for(name)
+                    stats["misses"] += 1
+                    stats["loads"] += 1
+                    stats["last_load_seconds"] = round(load_seconds, 4)
+                    stats["total_load_seconds"] += load_seconds
+                    self._entries[name] = kb
+                    self.total_bytes += kb.nbytes
+                    self._evict()
+                return kb
+        finally:
+            # Load locks only live while a load is in flight
+            with self._lock:
+                if self._load_locks.get(name) is load_lock:
+                    del self._load_locks[name]
+
+    def _evict(self):
+        # Drop least recently used entries until within budget, always keeping the newest
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, kb = self._entries.popitem(last=False)
+            self.total_bytes -= kb.nbytes
+            self.evictions += 1
+            print(f"♻️ Evicted knowledge base '{name}'")
+
+    def peek(self, name: str):
+        """Return a cached knowledge base without loading it or touching LRU order"""
+        with self._lock:
+            return self._entries.get(name)
+
+    def stats(self) -> Dict:
+        """Per knowledge base load times and hit rates, plus cache totals"""
+        with self._lock:
+            knowledge_bases = {}
+            for name, stats in self._stats.items():
+                requests = stats["hits"] + stats["misses"]
+                kb = self._entries.get(name)
+                knowledge_bases[name] = {
+                    **stats,
+                    "total_load_seconds": round(stats["total_load_seconds"], 4),
+                    "hit_rate": round(stats["hits"] / requests, 4) if requests else None,
+                    "loaded": kb is not None,
+                    "bytes": kb.nbytes if kb is not None else None
+                }
+            return {
+                "max_bytes": self.max_bytes,
+                "total_bytes": self.total_bytes,
+                "loaded": list(self._entries),
+                "evictions": self.evictions,
+                "knowledge_bases": knowledge_bases
+            }
@@ -0,0 +1,216 @@
+"""
+On-demand profiling of live detection requests.
+
+An admin turns capture on for the next N requests or T seconds. While it is
+on, each request is wrapped in either the torch profiler (operator timings,
+Python stacks, Chrome trace) or a lightweight stack sampler, and the
+pipeline stages (YOLO, ResNet18, k-NN) are timed and labeled. When capture
+is off, each request reads one boolean attribute and each stage costs a
+method call that returns a shared no-op context.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+import torch
+
+PROFILE_MODES = ("torch", "sampling")
+MAX_CAPTURE_REQUESTS = 50
+MAX_CAPTURE_SECONDS = 600
+
+# Shared no-op context returned by stage() when not capturing
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id: int, stacks: Counter, lock: threading.Lock, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.stacks = stacks
+        self.lock = lock
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                stack = ";".join(reversed(frames))
+                with self.lock:
+                    self.stacks[stack] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class ProfileCapture:
+    def __init__(self):
+        # The only attribute a request reads when capture is off
+        self.active = False
+        self.mode = None
+        self.remaining_requests = 0
+        self.expires_at = None
+        self.started_at = None
+        self.captured_requests = 0
+        self._capturing = False
+        self._stage_times = {}
+        self._stacks = Counter()
+        self._trace_events = []
+        self._lock = threading.Lock()
+
+    def start(self, mode: str, requests: Optional[int], seconds: Optional[float]) -> Dict:
+        """Arm capture for the next N requests and/or T seconds, discarding earlier results"""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+        if requests is None and seconds is None:
+            raise ValueError("Set requests, seconds, or both")
+        if requests is not None and not 0 < requests <= MAX_CAPTURE_REQUESTS:
+            raise ValueError(f"requests must be between 1 and {MAX_CAPTURE_REQUESTS}")
+        if seconds is not None and not 0 < seconds <= MAX_CAPTURE_SECONDS:
+            raise ValueError(f"seconds must be greater than 0 and at most {MAX_CAPTURE_SECONDS}")
+        with self._lock:
+            if self.active:
+                raise RuntimeError("A capture is already running")
+            self.mode = mode
+            self.remaining_requests = requests or MAX_CAPTURE_REQUESTS
+            self.started_at = time.time()
+            self.expires_at = self.started_at + (seconds or MAX_CAPTURE_SECONDS)
+            self.captured_requests = 0
+            self._stage_times = {}
+            self._stacks = Counter()
+            self._trace_events = []
+            self.active = True
+        return self.status()
+
+    def stop(self) -> Dict:
+        with self._lock:
+            self.active = False
+        return self.status()
+
+    def _claim(self) -> bool:
+        """Reserve one capture slot for the current request, expiring the capture if done"""
+        with self._lock:
+            if not self.active:
+                return False
+            if time.time() >= self.expires_at:
+                self.active = False
+                return False
+            self.remaining_requests -= 1
+            if self.remaining_requests <= 0:
+                self.active = False
+            return True
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Profile the request run inside this block if a capture slot is available"""
+        if not self._claim():
+            yield
+            return
+
+        self._capturing = True
+        try:
+            if self.mode == "torch":
+                # export_stacks() writes nothing unless the profiler runs verbose
+                with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                            record_shapes=True, with_stack=True,
+                                            experimental_config=torch._C._profiler._ExperimentalConfig(verbose=True)) as prof:
+                    yield
+                self._collect_torch(prof)
+            else:
+                with StackSampler(threading.get_ident(), self._stacks, self._lock):
+                    yield
+        finally:
+            self._capturing = False
+            with self._lock:
+                self.captured_requests += 1
+
+    def _collect_torch(self, prof):
+        """Merge one request's Chrome trace and stacks into the capture results"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trace_path = os.path.join(temp_dir, "trace.json")
+            stacks_path = os.path.join(temp_dir, "stacks.txt")
+            prof.export_chrome_trace(trace_path)
+            prof.export_stacks(stacks_path, "self_cpu_time_total")
+            with open(trace_path) as f:
+                events = json.load(f).get("traceEvents", [])
+            with open(stacks_path) as f:
+                stacks = [line.rstrip("\n").rpartition(" ") for line in f]
+        with self._lock:
+            self._trace_events.extend(events)
+            for stack, _, value in stacks:
+                if stack:
+                    self._stacks[stack] += int(value)
+
+    def stage(self, name: str):
+        """Label and time a pipeline stage; a shared no-op unless this request is captured"""
+        if not self._capturing:
+            return _NULL_CONTEXT
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name: str):
+        start = time.perf_counter()
+        if self.mode == "torch":
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self._stage_times.setdefault(name, {"calls": 0, "total_ms": 0.0})
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed * 1000
+
+    def status(self) -> Dict:
+        with self._lock:
+            # A time-limited capture may lapse with no request arriving to notice
+            if self.active and time.time() >= self.expires_at:
+                self.active = False
+            stages = {
+                name: {
+                    "calls": stats["calls"],
+                    "total_ms": round(stats["total_ms"], 2),
+                    "mean_ms": round(stats["total_ms"] / stats["calls"], 3)
+                }
+                for name, stats in self._stage_times.items()
+            }
+            return {
+                "active": self.active,
+                "mode": self.mode,
+                "started_at": self.started_at,
+                "expires_at": self.expires_at if self.active else None,
+                "captured_requests": self.captured_requests,
+                "remaining_requests": self.remaining_requests if self.active else 0,
+                "stages": stages,
+                "trace_available": bool(self._trace_events),
+                "stack_samples": sum(self._stacks.values())
+            }
+
+    def chrome_trace(self) -> Dict:
+        """All captured torch events as one Chrome/Perfetto trace"""
+        with self._lock:
+            return {"traceEvents": list(self._trace_events)}
+
+    def collapsed_stacks(self) -> str:
+        """Flamegraph-ready stacks: one 'frame;frame;frame value' line per unique stack"""
+        with self._lock:
+            return "".join(f"{stack} {value}\n" for stack, value in self._stacks.most_common())
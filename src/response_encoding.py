@@ -0,0 +1,95 @@
+"""
+Response encoding for the detection endpoints.
+
+Supports two layouts for the product list:
+  rows     - one JSON object per product (the original format)
+  columnar - parallel arrays of crop ids, boxes, labels and scores
+
+and two wire formats chosen from the Accept header: JSON (serialized with
+orjson) or MessagePack.
+"""
+
+from typing import Dict, List, Optional
+
+import msgpack
+import orjson
+from fastapi.responses import Response
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+LAYOUTS = ("rows", "columnar")
+
+
+def to_columnar(products: List[Dict]) -> Dict:
+    """Turn a list of product dicts into parallel arrays"""
+    return {
+        "crop_ids": [p["crop_id"] for p in products],
+        # Flattened [x1, y1, x2, y2, x1, y1, ...] in original image pixels
+        "boxes": [v for p in products for v in p["box"]],
+        "detection_scores": [p["detection_confidence"] for p in products],
+        # Labels and scores are null for detection-only results
+        "labels": [p.get("product_name") for p in products],
+        "scores": [p.get("confidence") for p in products]
+    }
+
+
+def _parse_accept(accept: str) -> Dict[str, float]:
+    """Map each media range in an Accept header to its q-value"""
+    ranges = {}
+    for part in accept.split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges[media_type.lower()] = q
+    return ranges
+
+
+def _quality(media_type: str, ranges: Dict[str, float]) -> float:
+    """q-value for a concrete media type, taken from the most specific matching range"""
+    for candidate in (media_type, media_type.split("/")[0] + "/*", "*/*"):
+        if candidate in ranges:
+            return ranges[candidate]
+    return 0.0
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """True when the client's Accept header rates MessagePack above JSON (ties go to JSON)"""
+    if not accept:
+        return False
+    ranges = _parse_accept(accept)
+    msgpack_q = max(_quality(media_type, ranges) for media_type in MSGPACK_MEDIA_TYPES)
+    return msgpack_q > _quality("application/json", ranges)
+
+
+def encode_response(content: Dict, accept: Optional[str]) -> Response:
+    """Serialize a response body in the format negotiated via the Accept header"""
+    # The body depends on Accept, so caches must key on it
+    headers = {"Vary": "Accept"}
+    if wants_msgpack(accept):
+        return Response(content=msgpack.packb(content, use_bin_type=True),
+                        media_type=MSGPACK_MEDIA_TYPES[0], headers=headers)
+    return Response(content=orjson.dumps(content), media_type="application/json", headers=headers)
+
+
+def build_detection_response(products: List[Dict], quality: Dict, filename: Optional[str],
+                             knowledge_base: str, timestamp: float, layout: str, accept: Optional[str]) -> Response:
+    """Assemble and encode the /detect-products response body"""
+    response = {
+        "success": True,
+        "total_products": len(products),
+        "products": to_columnar(products) if layout == "columnar" else products,
+        "quality": quality,
+        "processing_info": {
+            "input_filename": filename,
+            "knowledge_base": knowledge_base,
+            "timestamp": timestamp
+        }
+    }
+    return encode_response(response, accept)
@@ -0,0 +1,32 @@
+"""
+Tests for access control on the /admin endpoints
+"""
+
+from fastapi.testclient import TestClient
+
+import app as server
+
+client = TestClient(server.app)
+
+
+def test_admin_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", None)
+    assert client.get("/admin/profile").status_code == 404
+    assert client.post("/admin/profile?requests=5").status_code == 404
+    assert not server.detector.profiler.active
+
+
+def test_admin_requires_matching_token(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "s3cret")
+    assert client.get("/admin/profile").status_code == 403
+    assert client.get("/admin/profile", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    response = client.get("/admin/profile", headers={"X-Admin-Token": "s3cret"})
+    assert response.status_code == 200
+    assert response.json()["active"] is False
+
+
+def test_capture_over_the_request_cap_is_rejected(monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "s3cret")
+    response = client.post("/admin/profile?requests=100", headers={"X-Admin-Token": "s3cret"})
+    assert response.status_code == 400
+    assert not server.detector.profiler.active
@@ -0,0 +1,114 @@
+"""
+Tests for the bulk processing checkpoint and output handling
+"""
+
+import json
+
+import pytest
+
+import bulk_process
+
+
+def test_resume_after_torn_checkpoint_write(tmp_path):
+    """A half-written checkpoint line must not block later commits"""
+    checkpoint = tmp_path / "results.jsonl.checkpoint"
+    bulk_process.append_checkpoint(checkpoint, ["a", "b"], {"output_bytes": 10})
+    # Simulate the job being killed mid-write
+    with open(checkpoint, "a") as f:
+        f.write('{"images": ["x", "y"], "sta')
+
+    completed, state, _ = bulk_process.load_checkpoint(checkpoint)
+    assert completed == {"a", "b"}
+    assert state == {"output_bytes": 10}
+
+    # Resumed run commits more batches
+    bulk_process.append_checkpoint(checkpoint, ["c", "d"], {"output_bytes": 20})
+    bulk_process.append_checkpoint(checkpoint, ["e"], {"output_bytes": 25})
+
+    completed, state, _ = bulk_process.load_checkpoint(checkpoint)
+    assert completed == {"a", "b", "c", "d", "e"}
+    assert state == {"output_bytes": 25}
+
+
+def test_failed_images_are_not_checkpointed(tmp_path):
+    """Failures go to the errors file and stay pending so a resume retries them"""
+    output = tmp_path / "results.jsonl"
+    checkpoint = tmp_path / "results.jsonl.checkpoint"
+    errors_file = tmp_path / "results.jsonl.errors.jsonl"
+    writer = bulk_process.JsonlWriter(output)
+    writer.resume({})
+
+    batch = [
+        {"image": "ok.jpg", "total_products": 0, "products": [], "quality": "full"},
+        {"image": "bad.jpg", "error": "cannot identify image file"}
+    ]
+    bulk_process.commit_batch(batch, writer, checkpoint, errors_file)
+
+    completed, state, _ = bulk_process.load_checkpoint(checkpoint)
+    assert completed == {"ok.jpg"}
+    assert state["output_bytes"] == output.stat().st_size
+    assert [json.loads(line)["image"] for line in output.read_text().splitlines()] == ["ok.jpg"]
+    assert [json.loads(line)["image"] for line in errors_file.read_text().splitlines()] == ["bad.jpg"]
+
+
+def test_existing_output_without_checkpoint_is_not_overwritten(tmp_path):
+    source = tmp_path / "images"
+    source.mkdir()
+    output = tmp_path / "results.jsonl"
+    output.write_text('{"image": "earlier.jpg"}\n')
+
+    with pytest.raises(SystemExit, match="no checkpoint"):
+        bulk_process.bulk_process(source, output, "jsonl", workers=1, batch_size=8)
+    assert output.read_text() == '{"image": "earlier.jpg"}\n'
+
+
+@pytest.mark.parametrize("fmt, knowledge_base", [("jsonl", "store_b"), ("parquet", "default")])
+def test_resume_with_different_options_is_refused(tmp_path, fmt, knowledge_base):
+    """Resuming must not mix catalogs or hand one writer the other's state"""
+    source = tmp_path / "images"
+    source.mkdir()
+    output = tmp_path / "results.jsonl"
+    checkpoint = tmp_path / "results.jsonl.checkpoint"
+    output.write_text('{"image": "a.jpg"}\n')
+    bulk_process.append_run_params(checkpoint, {"format": "jsonl", "knowledge_base": "default"})
+    bulk_process.append_checkpoint(checkpoint, ["a.jpg"], {"output_bytes": 19})
+
+    with pytest.raises(SystemExit, match="knowledge_base=default"):
+        bulk_process.bulk_process(source, output, fmt, workers=1, batch_size=8,
+                                  knowledge_base=knowledge_base)
+    assert output.read_text() == '{"image": "a.jpg"}\n'
+    completed, state, params = bulk_process.load_checkpoint(checkpoint)
+    assert completed == {"a.jpg"}
+    assert params == {"format": "jsonl", "knowledge_base": "default"}
+
+
+def test_missing_knowledge_base_fails_before_starting_workers(tmp_path):
+    """Workers that can't load models would otherwise leave the job hanging"""
+    source = tmp_path / "images"
+    source.mkdir()
+    (source / "shelf.jpg").write_bytes(b"")
+    output = tmp_path / "results.jsonl"
+
+    with pytest.raises(SystemExit, match="no_such_kb"):
+        bulk_process.bulk_process(source, output, "jsonl", workers=1, batch_size=8,
+                                  knowledge_base="no_such_kb")
+    assert not output.exists()
+    assert not (tmp_path / "results.jsonl.checkpoint").exists()
+
+
+def test_parquet_keeps_images_without_detections(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    writer = bulk_process.ParquetWriter(tmp_path / "results_parquet")
+    writer.resume({})
+    writer.write([
+        {"image": "empty.jpg", "total_products": 0, "products": [], "quality": "full"},
+        {"image": "shelf.jpg", "total_products": 1, "quality": "full", "products": [
+            {"crop_id": "shelf", "box": [1.0, 2.0, 3.0, 4.0], "detection_confidence": 0.9,
+             "product_name": "fanta_pet", "confidence": 0.8}
+        ]}
+    ])
+
+    rows = pq.read_table(tmp_path / "results_parquet").to_pylist()
+    assert [row["image"] for row in rows] == ["empty.jpg", "shelf.jpg"]
+    assert rows[0]["crop_id"] is None and rows[0]["product_name"] is None
+    assert rows[1]["product_name"] == "fanta_pet"
@@ -0,0 +1,59 @@
+"""
+Tests for deadline-aware quality selection and load shedding
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as server
+from src.deadline_policy import QUALITY_LEVELS, SEED_CROP_SECONDS, DeadlinePolicy
+
+
+def test_inflated_knn_estimate_recovers_while_degraded():
+    """A slow burst must not keep tight-deadline traffic at detection-only forever"""
+    policy = DeadlinePolicy()
+    policy.yolo_seconds_at_default = 0.2
+    policy.crops_per_image = 10
+    # One slow burst inflates the k-NN per-crop estimate
+    policy.crop_seconds["knn"] = 5.0
+    assert policy.choose_level(1.0)["classifier"] is None
+
+    # Requests now run detection-only, so k-NN is never observed
+    for _ in range(100):
+        policy.record_classification(None, 0.0, 0)
+
+    assert abs(policy.crop_seconds["knn"] - SEED_CROP_SECONDS["knn"]) < 0.05
+    assert policy.choose_level(3.0) is QUALITY_LEVELS[0]
+
+
+def test_observed_classifier_tracks_observations():
+    policy = DeadlinePolicy()
+    for _ in range(50):
+        policy.record_classification("knn", 0.5, 10)
+    assert abs(policy.crop_seconds["knn"] - 0.05) < 1e-3
+
+
+def test_admission_sheds_when_queue_cannot_finish_in_time():
+    policy = DeadlinePolicy()
+    policy.service_seconds = 0.5
+    # No deadline: always admitted
+    assert policy.admits(None, 100)
+    # Budget already gone
+    assert not policy.admits(0.0, 0)
+    # Empty queue with budget left is always admitted
+    assert policy.admits(0.1, 0)
+    # Three requests ahead need ~1.5s, more than the 1s left
+    assert not policy.admits(1.0, 3)
+    assert policy.admits(2.0, 3)
+
+
+@pytest.mark.parametrize("deadline_ms", ["0", "-100"])
+def test_endpoints_reject_non_positive_deadlines(deadline_ms):
+    """0 must not mean 'no deadline', and a negative budget is not worth retrying"""
+    client = TestClient(server.app)
+    response = client.post("/detect-products", data={"deadline_ms": deadline_ms},
+                           files={"file": ("shelf.jpg", b"\xff\xd8", "image/jpeg")})
+    assert response.status_code == 422
+    response = client.post(f"/detect-products/raw?deadline_ms={deadline_ms}", content=b"\xff\xd8",
+                           headers={"Content-Type": "image/jpeg"})
+    assert response.status_code == 422
@@ -0,0 +1,45 @@
+"""
+Tests that the buffered embedding path matches the original torchvision one
+"""
+
+import glob
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from src.img2vec_resnet18 import Img2VecResnet18
+
+
+def reference_vec(img2vec, img):
+    """Original getVec: ToTensor + Normalize and a forward hook on avgpool"""
+    image = img2vec.normalize(img2vec.toTensor(img)).unsqueeze(0).to(img2vec.device)
+    embedding = torch.zeros(1, img2vec.numberFeatures, 1, 1)
+
+    def copyData(m, i, o):
+        embedding.copy_(o.data)
+
+    h = img2vec.featureLayer.register_forward_hook(copyData)
+    with torch.no_grad():
+        img2vec.model(image)
+    h.remove()
+    return embedding.numpy()[0, :, 0, 0]
+
+
+@pytest.fixture(scope="module")
+def img2vec():
+    return Img2VecResnet18()
+
+
+def test_get_vec_matches_reference_embedding(img2vec):
+    """Saved knowledge bases were built with the original path"""
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+              for h, w in [(224, 224), (97, 181), (640, 480)]]
+    for path in sorted(glob.glob("data/knowledge_base/crops/object/**/*.jpg"))[:5]:
+        with Image.open(path) as img:
+            images.append(img.convert("RGB"))
+
+    for img in images:
+        np.testing.assert_allclose(img2vec.getVec(img), reference_vec(img2vec, img), atol=1e-5)
@@ -0,0 +1,54 @@
+"""
+Tests for the knowledge base LRU cache
+"""
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from src import knowledge_base
+from src.knowledge_base import KnowledgeBaseCache
+
+
+def make_knowledge_base(directory, name, num_samples=20):
+    rng = np.random.default_rng(0)
+    embeddings = rng.random((num_samples, 8)).astype(np.float32)
+    classes = np.array(["a", "b"] * (num_samples // 2))
+    knn_model = NearestNeighbors(metric="cosine", n_neighbors=5).fit(embeddings)
+    joblib.dump({"knn_model": knn_model, "classes": classes, "embeddings": embeddings,
+                 "n_neighbors": 5}, directory / f"{name}.pkl")
+
+
+@pytest.fixture
+def kb_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(knowledge_base, "KNOWLEDGE_BASE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_unknown_names_leave_no_state(kb_dir):
+    cache = KnowledgeBaseCache(max_bytes=10 * 1024 * 1024)
+    for i in range(100):
+        with pytest.raises(KeyError):
+            cache.get(f"missing_{i}")
+    assert cache._load_locks == {}
+    assert cache.stats()["knowledge_bases"] == {}
+
+
+def test_lazy_load_hit_rate_and_lru_eviction(kb_dir):
+    for name in ("chain_a", "chain_b", "chain_c"):
+        make_knowledge_base(kb_dir, name)
+    size = knowledge_base.KnowledgeBase.load("chain_a").nbytes
+    cache = KnowledgeBaseCache(max_bytes=2 * size)
+
+    cache.get("chain_a")
+    cache.get("chain_a")
+    cache.get("chain_b")
+    cache.get("chain_c")
+
+    stats = cache.stats()
+    assert stats["loaded"] == ["chain_b", "chain_c"]
+    assert stats["evictions"] == 1
+    assert stats["knowledge_bases"]["chain_a"]["hit_rate"] == 0.5
+    assert stats["knowledge_bases"]["chain_a"]["loaded"] is False
+    assert cache._load_locks == {}
@@ -0,0 +1,77 @@
+"""
+Tests for on-demand profile capture
+"""
+
+import time
+
+import pytest
+import torch
+
+from src.profiling import MAX_CAPTURE_REQUESTS, MAX_CAPTURE_SECONDS, ProfileCapture
+
+
+def test_torch_capture_produces_collapsed_stacks():
+    profiler = ProfileCapture()
+    profiler.start("torch", requests=1, seconds=None)
+    with profiler.capture():
+        with profiler.stage("resnet18"):
+            torch.nn.functional.relu(torch.randn(64, 64) @ torch.randn(64, 64))
+
+    assert profiler.collapsed_stacks().strip()
+    status = profiler.status()
+    assert status["trace_available"]
+    assert status["stack_samples"] > 0
+
+
+def test_capture_limits_are_validated():
+    profiler = ProfileCapture()
+    for requests, seconds in [(None, None), (0, None), (MAX_CAPTURE_REQUESTS + 1, None),
+                              (None, -1), (None, MAX_CAPTURE_SECONDS + 1)]:
+        with pytest.raises(ValueError):
+            profiler.start("sampling", requests, seconds)
+    with pytest.raises(ValueError):
+        profiler.start("perf", 5, None)
+    assert not profiler.active
+
+
+def test_capture_stops_after_requested_count():
+    profiler = ProfileCapture()
+    profiler.start("sampling", requests=2, seconds=None)
+    with pytest.raises(RuntimeError):
+        profiler.start("sampling", requests=2, seconds=None)
+
+    for _ in range(3):
+        with profiler.capture():
+            with profiler.stage("yolo"):
+                pass
+            with profiler.stage("knn"):
+                pass
+
+    status = profiler.status()
+    assert not status["active"]
+    assert status["captured_requests"] == 2
+    assert status["stages"]["yolo"]["calls"] == 2
+    assert status["stages"]["knn"]["calls"] == 2
+    assert status["stages"]["yolo"]["total_ms"] >= 0
+
+
+def test_capture_expires_after_requested_seconds():
+    profiler = ProfileCapture()
+    profiler.start("sampling", requests=None, seconds=60)
+    assert profiler.status()["remaining_requests"] == MAX_CAPTURE_REQUESTS
+    # Pretend the time limit has passed with no request arriving
+    profiler.expires_at = time.time() - 1
+    assert not profiler.status()["active"]
+
+    with profiler.capture():
+        with profiler.stage("yolo"):
+            pass
+    assert profiler.status()["captured_requests"] == 0
+    assert profiler.status()["stages"] == {}
+
+
+def test_stage_is_a_no_op_outside_a_capture():
+    profiler = ProfileCapture()
+    with profiler.stage("resnet18"):
+        pass
+    assert profiler.status()["stages"] == {}
@@ -0,0 +1,42 @@
+"""
+Tests for response content negotiation and layouts
+"""
+
+import msgpack
+
+from src.response_encoding import build_detection_response, encode_response, to_columnar, wants_msgpack
+
+
+def test_wants_msgpack_honours_q_values():
+    assert not wants_msgpack(None)
+    assert not wants_msgpack("application/json")
+    assert not wants_msgpack("*/*")
+    assert wants_msgpack("application/msgpack")
+    assert wants_msgpack("application/json;q=0.1, application/msgpack")
+    assert not wants_msgpack("application/msgpack;q=0.5, application/json")
+    assert wants_msgpack("application/x-msgpack, */*;q=0.8")
+    # Ties go to JSON
+    assert not wants_msgpack("application/msgpack, application/json")
+
+
+def test_columnar_layout_and_msgpack_body():
+    products = [
+        {"crop_id": "shelf", "box": [1.0, 2.0, 3.0, 4.0], "detection_confidence": 0.9,
+         "product_name": "fanta_pet", "confidence": 0.8},
+        {"crop_id": "shelf2", "box": [5.0, 6.0, 7.0, 8.0], "detection_confidence": 0.7}
+    ]
+    columns = to_columnar(products)
+    assert columns["boxes"] == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0]
+    assert columns["labels"] == ["fanta_pet", None]
+
+    response = build_detection_response(products, {"level": 0}, "shelf.jpg", "default",
+                                        0.0, "columnar", "application/msgpack")
+    assert response.media_type == "application/msgpack"
+    body = msgpack.unpackb(response.body)
+    assert body["total_products"] == 2
+    assert body["products"]["crop_ids"] == ["shelf", "shelf2"]
+
+
+def test_responses_vary_on_accept():
+    for accept in (None, "application/json", "application/msgpack"):
+        assert encode_response({"success": True}, accept).headers["vary"] == "Accept"
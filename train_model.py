@@ -3,29 +3,31 @@ Script to train and save the k-NN model for faster inference
 Run this once to pre-train the model, then the FastAPI server will load it
 """
 
+import argparse
 import os
 import glob
 import joblib
 import numpy as np
 from pathlib import Path
 from src.img2vec_resnet18 import Img2VecResnet18
+from src.knowledge_base import DEFAULT_KNOWLEDGE_BASE, knowledge_base_path
 from sklearn.neighbors import NearestNeighbors
 from collections import Counter
 import time
 
-def train_knn_model():
-    """Train k-NN model on knowledge base and save it"""
+def train_knn_model(name=DEFAULT_KNOWLEDGE_BASE, data_path='../data'):
+    """Train k-NN model on a knowledge base and save it under the given name"""
     
-    print("🚀 Starting k-NN model training...")
+    print(f"🚀 Starting k-NN model training for knowledge base '{name}'...")
     start_time = time.time()
     
     # Configuration
-    DATA_PATH = '../data'
-    MODEL_PATH = 'models'
+    DATA_PATH = data_path
     N_NEIGHBORS = 5
+    model_file = knowledge_base_path(name)
     
     # Create models directory if it doesn't exist
-    os.makedirs(MODEL_PATH, exist_ok=True)
+    os.makedirs(os.path.dirname(model_file), exist_ok=True)
     
     # Get knowledge base images
     print("📚 Loading knowledge base images...")
@@ -90,7 +92,6 @@ def train_knn_model():
         'num_training_samples': len(embeddings)
     }
     
-    model_file = os.path.join(MODEL_PATH, 'knn_model.pkl')
     joblib.dump(model_data, model_file)
     
     # Print summary
@@ -117,8 +118,14 @@ def train_knn_model():
     return model_file
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a k-NN knowledge base")
+    parser.add_argument("--name", default=DEFAULT_KNOWLEDGE_BASE,
+                        help="Knowledge base name, e.g. a retail chain (default: models/knn_model.pkl)")
+    parser.add_argument("--data-path", default='../data',
+                        help="Folder containing knowledge_base/crops/object/<class>/*.jpg")
+    args = parser.parse_args()
     try:
-        train_knn_model()
+        train_knn_model(args.name, args.data_path)
     except Exception as e:
         print(f"❌ Training failed: {e}")
         exit(1)